@@ -5,14 +5,32 @@ Date:       12 February 2021
 Code sourced from: https://raw.githubusercontent.com/ImageMarkup/isic-archive/master/scripts/isic_api.py
 """
 
+import json
 import logging
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from time import perf_counter
+from typing import Any, Callable
 
 logger = logging.getLogger(__name__)
 
+# Use the fastest JSON library available, falling back to the standard library.
+try:
+    import orjson
+
+    decode_json = orjson.loads
+except ImportError:
+    try:
+        import ujson
+
+        decode_json = ujson.loads
+    except ImportError:
+        decode_json = json.loads
+
 
 def timeit(func: callable):
     """
@@ -45,10 +63,20 @@ class IsicApi(object):
                  hostname='https://isic-archive.com',
                  login: bool = False,
                  username=os.environ.get("ISIC_USERNAME", None),
-                 password=os.environ.get("ISIC_PASSWORD", None)):
+                 password=os.environ.get("ISIC_PASSWORD", None),
+                 decoder: Callable[[bytes], Any] = None,
+                 pool_size: int = 10):
 
         self.base_url = f'{hostname}/api/v1'
         self.auth_token = None
+        # Decodes response bodies, e.g. orjson.loads. It is sent to metadata --parse-workers processes,
+        # so custom decoders must be picklable, i.e. a module-level function rather than a lambda.
+        self.decode = decoder if decoder is not None else decode_json
+
+        # Share connections across requests and worker threads.
+        self.session = requests.Session()
+        self.pool_size = 0
+        self.resize_pool(pool_size)
 
         if username is not None and login is True:
             if password is None:
@@ -58,6 +86,22 @@ class IsicApi(object):
         else:
             logger.info(f"No login credentials found, sending request anonymously.")
 
+    def resize_pool(self, pool_size: int) -> None:
+        """
+        Grows the connection pool so it can hold a connection for each concurrent worker.
+
+        Connections beyond the pool size are discarded after use, losing their reuse.
+
+        :param pool_size: The number of threads that will share this client.
+        """
+        if pool_size <= self.pool_size:
+            return
+
+        self.pool_size = pool_size
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
     def _make_url(self, endpoint):
         """
         Helper to make the request url endpoint
@@ -76,7 +120,7 @@ class IsicApi(object):
         :return: The bearer token to use for subsequent requests.
         :raises Exception: When login attempt fails.
         """
-        authResponse = requests.get(
+        authResponse = self.session.get(
             self._make_url('user/authentication'),
             auth=(username, password)
         )
@@ -87,22 +131,38 @@ class IsicApi(object):
 
         return authToken
 
-    def get(self, endpoint, timeout: int = 5):
+    def get(self, endpoint, timeout: int = 5, headers: dict = None, stream: bool = False):
         """
         Issues get request to ISIC storage service.
 
         :param endpoint: The endpoint to access.
         :param timeout: The request timeout length in seconds.
+        :param headers: Extra headers to send with the request, e.g. Range.
+        :param stream: Stream the response body instead of downloading it immediately.
         :return: The result of the GET request.
         """
         url = self._make_url(endpoint)
-        headers = {'Girder-Token': self.auth_token} if self.auth_token else None
+        headers = {**(headers or {}), **({'Girder-Token': self.auth_token} if self.auth_token else {})} or None
 
-        return self._get(url, headers=headers, timeout=timeout)
+        return self._get(url, headers=headers, timeout=timeout, stream=stream)
 
     @timeit
-    def _get(self, url: str, headers: dict, timeout: int):
-        return requests.get(url, headers=headers, timeout=timeout)
+    def _get(self, url: str, headers: dict, timeout: int, stream: bool = False):
+        return self.session.get(url, headers=headers, timeout=timeout, stream=stream)
+
+    def get_raw(self, endpoint, limit: int = 50, offset: int = 0, timeout: int = 5) -> bytes:
+        """
+        Returns the undecoded content of the response.
+
+        :param endpoint: The endpoint to access.
+        :param limit: The limit of the responses.
+        :param offset: The offset to start the request objects from.
+        :param timeout: The request timeout length in seconds.
+        :return: The raw bytes of the response body.
+        """
+        _endpoint = f'{endpoint}&limit={limit:d}&offset={offset:d}'
+
+        return self.get(_endpoint, timeout=timeout).content
 
     def get_json(self, endpoint, limit: int = 50, offset: int = 0, timeout: int = 5):
         """
@@ -114,11 +174,9 @@ class IsicApi(object):
         :param timeout: The request timeout length in seconds.
         :return: The JSON segment of the response.
         """
-        _endpoint = f'{endpoint}&limit={limit:d}&offset={offset:d}'
-
-        return self.get(_endpoint, timeout=timeout).json()
+        return self.decode(self.get_raw(endpoint, limit=limit, offset=offset, timeout=timeout))
 
-    def get_json_list(self, endpoint, limit=50, offset=0, timeout: int = 5):
+    def get_json_list(self, endpoint, limit=50, offset=0, timeout: int = 5, prefetch: int = 0):
         """
         Retrieves a list of JSON objects depending on size of request.
 
@@ -126,16 +184,57 @@ class IsicApi(object):
         :param limit: The limit of the responses.
         :param offset: The offset to start the request objects from.
         :param timeout: The request timeout length in seconds.
+        :param prefetch: The number of pages to fetch ahead in the background, 0 fetches pages sequentially.
         :return: A JSON response item.
         """
         # endpoint += '&' if '?' in endpoint else '?'
 
-        while True:
-            _endpoint = f'{endpoint}&limit={limit:d}&offset={offset:d}'
+        if prefetch > 0:
+            yield from self._get_json_list_prefetch(endpoint, limit=limit, offset=offset, timeout=timeout, prefetch=prefetch)
+            return
 
-            resp = self.get(_endpoint, timeout=timeout).json()
+        while True:
+            resp = self.get_json(endpoint, limit=limit, offset=offset, timeout=timeout)
             if not resp:
                 break
             for elem in resp:
                 yield elem
             offset += limit
+
+    def _get_json_list_prefetch(self, endpoint, limit: int, offset: int, timeout: int, prefetch: int):
+        """
+        Retrieves a list of JSON objects, keeping up to `prefetch` pages in flight ahead of the consumer.
+
+        Pages are yielded in offset order. Requests issued past the last page are discarded.
+
+        :param endpoint: The endpoint to access.
+        :param limit: The limit of the responses.
+        :param offset: The offset to start the request objects from.
+        :param timeout: The request timeout length in seconds.
+        :param prefetch: The maximum number of pages requested ahead of the one being consumed.
+        :return: A JSON response item.
+        """
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            pending = deque()
+
+            def submit_next():
+                nonlocal offset
+                pending.append(executor.submit(self.get_json, endpoint, limit=limit, offset=offset, timeout=timeout))
+                offset += limit
+
+            try:
+                for _ in range(prefetch):
+                    submit_next()
+
+                while pending:
+                    resp = pending.popleft().result()
+                    if not resp:
+                        break
+                    # Keep the window full while the current page is consumed.
+                    submit_next()
+                    for elem in resp:
+                        yield elem
+            finally:
+                # Drop requests that have not started yet, e.g. pages past the end of the result set.
+                for future in pending:
+                    future.cancel()
@@ -3,28 +3,37 @@ Author:     David Walshe
 Date:       21 February 2021
 """
 
+import heapq
+import hashlib
 import logging
+import zipfile
 from collections import namedtuple
 from itertools import chain
 from queue import Queue
-from typing import List, Union
+from typing import Iterator, List, Tuple
 import os
 import json
 import urllib as urllib
-from concurrent.futures import ThreadPoolExecutor, as_completed, Future
+from concurrent.futures import ThreadPoolExecutor, Future
 
 import click
 import pandas as pd
 from alive_progress import alive_bar
 
-from src.cli.config import COMMAND_CONTEXT_SETTINGS
-from src.cli.utils import kwargs_to_namedtuple
+from src.cli.config import COMMAND_CONTEXT_SETTINGS, IN_FLIGHT_PER_WORKER
+from src.cli.utils import kwargs_to_namedtuple, read_metadata, submit_bounded, WhereExpressionError
 from src.cli.validators import check_file_exists
 from src.api.isic_api import IsicApi
 
 logger = logging.getLogger(__name__)
 
-DownloadCommandParameters = namedtuple("DownloadCommandParameters", ["metadata_file", "dataset", "include", "output", "retry", "timeout", "workers"])
+# Max size of download set by ISIC API
+MAX_DOWNLOAD_SIZE = 300
+
+# Rough compressed size of a dermoscopy JPEG, used to weigh batches against each other.
+BYTES_PER_PIXEL = 0.4
+
+DownloadCommandParameters = namedtuple("DownloadCommandParameters", ["metadata_file", "dataset", "include", "output", "retry", "timeout", "workers", "where", "attempts"])
 
 
 @click.command(**COMMAND_CONTEXT_SETTINGS, short_help="Download a group of images based on their ISIC imageIds.")
@@ -35,13 +44,15 @@ DownloadCommandParameters = namedtuple("DownloadCommandParameters", ["metadata_f
 @click.option("--retry", is_flag=True, help="Tries to download the missing records from a previous attempt.")
 @click.option("--timeout", type=int, default=60, help="The timeout length for each request to the API. Default=60")
 @click.option("-w", "--workers", type=int, default=5, help=f"Specify how many concurrent workers should be used. Default=5")
+@click.option("--attempts", type=int, default=3, help="How many times to try each batch, resuming partial transfers where the server allows it. Default=3")
+@click.option("--where", type=str, default=None, help="Only download images whose metadata matches this expression, e.g. \"benign_malignant == 'malignant' and pixels_x >= 1024\".")
 @kwargs_to_namedtuple(DownloadCommandParameters)
 def download(params: DownloadCommandParameters):
     """
     Download a group of images based on their ISIC imageIds.
     """
     # Show available datasets if non are selected.
-    if params.dataset is None:
+    if params.dataset is None and params.where is None:
         show_available_datasets(params)
 
     else:
@@ -52,16 +63,16 @@ def download(params: DownloadCommandParameters):
         error_queue = Queue()
 
         # Get the image ids to download
-        download_images(params, error_queue)
+        try:
+            download_images(params, error_queue)
+        except WhereExpressionError as e:
+            raise click.BadParameter(str(e), param_hint="'--where'")
 
-        # Record failed images to allow for --retry.
+        # Record failed batches to allow for --retry, kept whole so partial transfers can be resumed.
         failed_images = []
         while not error_queue.empty():
             failed_images.append(error_queue.get())
 
-        # flatten list to 1D.
-        failed_images = list(chain.from_iterable(failed_images))
-
         # Save the image_ids to retry with --retry.
         with open(recovery_file_name(), "w") as fh:
             json.dump(failed_images, fh, indent=4)
@@ -79,7 +90,7 @@ def show_available_datasets(params: DownloadCommandParameters):
     :return:
     """
     print(f"\nDatasets available in '{params.metadata_file}':\n")
-    datasets = pd.read_csv(params.metadata_file)["dataset"]
+    datasets = pd.read_csv(params.metadata_file, usecols=["dataset"])["dataset"]
     items = datasets.value_counts()
     print(pd.DataFrame({"Datasets": items.index,
                         "Instances": items.values}))
@@ -95,93 +106,205 @@ def create_download_path(params: DownloadCommandParameters) -> None:
         os.makedirs(params.output)
 
 
-def download_images(params: DownloadCommandParameters, error_queue: Queue):
+def download_images(params: DownloadCommandParameters, error_queue: Queue, api: IsicApi = None, image_ids: List[str] = None,
+                    image_sizes: List[int] = None, image_batches: List[List[str]] = None):
     """
     Uses a thread pool to download image metadata concurrently.
 
     :param params: The CLI parameters.
     :param error_queue: A queue to capture errors.
+    :param api: The API client to reuse, a new one is created if not passed.
+    :param image_ids: The image ids to download, read from the metadata file if not passed.
+    :param image_sizes: The estimated size in bytes of each image, read from the metadata file if not passed.
+    :param image_batches: Batches that failed previously, downloaded whole instead of image_ids so their partial transfers resume.
     :return: The tuple of metadata results and names of images that failed to download.
     """
-    api = IsicApi()
+    api = api if api is not None else IsicApi()
+    api.resize_pool(params.workers)
 
-    # Max size of download set by ISIC API
-    MAX_DOWNLOAD_SIZE = 300
+    # Failed batches from a previous attempt are kept whole so their partial downloads can be resumed.
+    if image_batches is None and params.retry:
+        logger.info(f"Attempting to download previously failed images.")
+        image_batches = get_retry_batches()
 
     # Get all the image ids from the
-    image_ids = get_image_ids(params)
+    if image_batches is not None:
+        image_ids = list(chain.from_iterable(image_batches))
+    elif image_ids is None:
+        image_ids = get_image_ids(params)
+
+    if image_sizes is None:
+        image_sizes = get_image_sizes(params, image_ids)
+
+    total_size = sum(image_sizes)
 
-    # Get all batches.
-    image_batches = list(chunks(image_ids, MAX_DOWNLOAD_SIZE))
+    if image_batches is not None:
+        sizes = dict(zip(image_ids, image_sizes))
+        # Send the heaviest batches first, as make_batches does.
+        image_batches = sorted(((sum(sizes[image_id] for image_id in batch), batch) for batch in image_batches),
+                               key=lambda item: item[0], reverse=True)
+    else:
+        # Balance the batches by size and send the heaviest first to shorten the tail of the download.
+        # Batches are streamed to the workers as they free up.
+        image_batches = make_batches(image_ids, image_sizes, MAX_DOWNLOAD_SIZE)
+
+    failed_batches = []
 
-    # Measure the download progress for the full dataset.
-    with alive_bar(len(image_batches), title="Total Progress", enrich_print=False) as total_bar:
+    # Measure the download progress for the full dataset in estimated bytes.
+    with alive_bar(total_size, title="Total Progress", enrich_print=False) as total_bar:
         # Run concurrent workers to download ìmages.
         with ThreadPoolExecutor(max_workers=params.workers) as executor:
-            # Create a worker with a set of images to request and download.
-            futures_to_request = {executor.submit(make_request, api, batch, params): batch for batch_idx, batch in enumerate(image_batches)}
-            for index, future in enumerate(as_completed(futures_to_request)):
+            # Create a worker with a set of images to request and download, bounding the requests in flight.
+            completed = submit_bounded(executor, lambda item: make_request(api, item[1], params), image_batches, IN_FLIGHT_PER_WORKER * params.workers)
+            for (batch_size, batch), future in completed:
                 try:
-                    process_workers(index, future, params)
-                    total_bar()
+                    process_workers(future)
+                    total_bar(incr=batch_size)
                 except Exception as e:
                     logger.error(f"{e}")
-                    error_queue.put(futures_to_request[future])
+                    error_queue.put(batch)
+                    failed_batches.append(batch)
+
+    # Partial downloads can only be resumed through the batches that failed in this run.
+    remove_stale_parts(params, failed_batches)
 
 
-def process_workers(worker_id: int, future: Future, params: DownloadCommandParameters) -> None:
+def process_workers(future: Future) -> None:
     """
     Processes each image download worker.
 
-    :param worker_id: The id of the worker.
-    :param future: The future object to retrieve the response from.
-    :param params: The CLI parameters.
+    :param future: The future object to retrieve the downloaded file from.
     """
     # Wait for the result.
-    res = future.result()
-    # If response is empty, let the user know.
-    if not res:
-        logger.error(f"No data in response.")
-        raise ValueError("Issue downloading images.")
-    else:
-        download_file = os.path.join(params.output, f"download_{worker_id}.zip")
-        with open(download_file, "wb") as stream:
-            for item in res:
-                stream.write(item)
+    download_file = future.result()
+    logger.info(f"Saved '{download_file}'.")
 
 
 def get_image_ids(params: DownloadCommandParameters) -> List[str]:
     """
-    Gather all the image ids for a specific Dataset.
+    Gather all the image ids for a specific Dataset and/or --where expression.
 
     :param params: The command line parameters.
     :return: The ISIC image ids for the dataset requested.
     """
-    if params.retry:
-        logger.info(f"Attempting to download previously failed images.")
-        with open(recovery_file_name()) as fh:
-            image_ids = json.load(fh)
-    else:
-        df = pd.read_csv(params.metadata_file)
-        image_ids = df[df["dataset"] == params.dataset]["isic_id"]
+    # Only load the columns needed to select the images.
+    columns = ["isic_id"] if params.dataset is None else ["isic_id", "dataset"]
+    df = read_metadata(params.metadata_file, columns=columns, where=params.where)
+    if params.dataset is not None:
+        df = df[df["dataset"] == params.dataset]
+    image_ids = df["isic_id"]
+    logger.info(f"{len(image_ids)} images selected for download.")
 
     return list(image_ids)
 
 
-def chunks(data: list, n: int) -> list:
-    """Yield successive n-sized chunks from data."""
-    for i in range(0, len(data), n):
-        yield data[i:i + n]
+def get_retry_batches() -> List[List[str]]:
+    """
+    Reads the failed batches recorded by a previous attempt.
+
+    :return: The failed batches of image ids.
+    """
+    with open(recovery_file_name()) as fh:
+        failed = json.load(fh)
+
+    # Earlier versions recorded a flat list of image ids.
+    if failed and not isinstance(failed[0], list):
+        return [failed[i:i + MAX_DOWNLOAD_SIZE] for i in range(0, len(failed), MAX_DOWNLOAD_SIZE)]
+
+    return failed
+
 
+def get_image_sizes(params: DownloadCommandParameters, image_ids: List[str]) -> List[int]:
+    """
+    Reads the image dimensions from the metadata file to estimate the size of each image.
 
-def make_request(api: IsicApi, image_set: list, params: DownloadCommandParameters) -> Union[List[dict], None]:
+    :param params: The command line parameters.
+    :param image_ids: The ISIC image ids to estimate sizes for.
+    :return: The estimated size in bytes of each image, in the same order as image_ids.
     """
-    Make a image download request to the API.
+    if params.metadata_file is None:
+        return estimate_image_sizes(pd.DataFrame(), image_ids)
+
+    df = pd.read_csv(params.metadata_file, usecols=lambda column: column in ["isic_id", "pixels_x", "pixels_y"])
+
+    return estimate_image_sizes(df.set_index("isic_id"), image_ids)
+
+
+def estimate_image_sizes(metadata: pd.DataFrame, image_ids: List[str]) -> List[int]:
+    """
+    Estimates the download size of each image from its pixels_x and pixels_y metadata.
+
+    Images without dimensions are given the median size of the others, or a uniform size if none are known.
+
+    :param metadata: The image metadata indexed by isic_id.
+    :param image_ids: The ISIC image ids to estimate sizes for.
+    :return: The estimated size in bytes of each image, in the same order as image_ids.
+    """
+    if not {"pixels_x", "pixels_y"}.issubset(metadata.columns):
+        return [1] * len(image_ids)
+
+    metadata = metadata[~metadata.index.duplicated(keep="first")]
+    pixels = (metadata["pixels_x"] * metadata["pixels_y"]).reindex(image_ids)
+    sizes = (pixels * BYTES_PER_PIXEL).fillna(pixels.median() * BYTES_PER_PIXEL).fillna(1)
+
+    return [max(int(size), 1) for size in sizes]
+
+
+def make_batches(image_ids: List[str], image_sizes: List[int], n: int) -> Iterator[Tuple[int, List[str]]]:
+    """
+    Packs image ids into the fewest batches of at most n ids, balancing their total size.
+
+    Images are placed largest first into the lightest batch with room (LPT scheduling), and the
+    batches are yielded heaviest first so the largest downloads start earliest. Packing needs every
+    image size up front, so the ids are materialised, but each batch is released once yielded.
+
+    :param image_ids: The ISIC image ids to batch.
+    :param image_sizes: The estimated size of each image.
+    :param n: The maximum number of ids in a batch.
+    :return: The (estimated size, image ids) of each batch, heaviest first.
+    """
+    num_batches = -(-len(image_ids) // n)
+    batches = [[0, []] for _ in range(num_batches)]
+    lightest = [(0, index) for index in range(num_batches)]
+
+    for image_size, image_id in sorted(zip(image_sizes, image_ids), reverse=True):
+        _, index = heapq.heappop(lightest)
+        batches[index][0] += image_size
+        batches[index][1].append(image_id)
+        # Full batches take no more images.
+        if len(batches[index][1]) < n:
+            heapq.heappush(lightest, (batches[index][0], index))
+
+    for index in sorted(range(num_batches), key=lambda index: batches[index][0], reverse=True):
+        batch, batches[index] = batches[index], None
+        yield tuple(batch)
+
+
+def batch_file_name(params: DownloadCommandParameters, image_set: list) -> str:
+    """
+    The archive name for a batch, stable across attempts so partial transfers can be found again.
+
+    :param params: The command line parameters.
+    :param image_set: The image ids in the batch.
+    :return: The path of the archive for the batch.
+    """
+    digest = hashlib.md5(",".join(image_set).encode("utf-8")).hexdigest()[:16]
+
+    return os.path.join(params.output, f"download_{digest}.zip")
+
+
+def make_request(api: IsicApi, image_set: list, params: DownloadCommandParameters) -> str:
+    """
+    Make a image download request to the API, saving the archive to disk.
+
+    Each attempt streams into a ".part" file next to the archive. After a broken transfer the next attempt
+    requests only the missing bytes with a Range header, falling back to a full download if the server
+    does not honour it.
 
     :param api: The reference to tha API object.
     :param image_set: The image name to retrieve data on.
     :param params: The command line parameters.
-    :return: The data on the image or None.
+    :return: The path of the downloaded archive.
     """
     # Convert to a json array
     url_image_ids = json.dumps(str(image_set))
@@ -194,5 +317,157 @@ def make_request(api: IsicApi, image_set: list, params: DownloadCommandParameter
     # Create the endpoint URL
     endpoint = f"image/download?include={params.include}&imageIds={url_image_ids}"
 
-    # Request the images and return the response
-    return api.get(endpoint=endpoint, timeout=params.timeout)
+    download_file = batch_file_name(params, image_set)
+    part_file = f"{download_file}.part"
+
+    for attempt in range(1, max(params.attempts, 1) + 1):
+        try:
+            download_part(api, endpoint, part_file, params.timeout)
+            verify_archive(part_file)
+            break
+        except Exception as e:
+            if attempt >= params.attempts:
+                raise e
+            logger.warning(f"Attempt {attempt} for '{download_file}' failed, retrying: {e}")
+
+    os.replace(part_file, download_file)
+    remove_part(part_file, keep_data=True)
+
+    return download_file
+
+
+def download_part(api: IsicApi, endpoint: str, part_file: str, timeout: int) -> None:
+    """
+    Streams a response into a partial file, resuming from the bytes already received when possible.
+
+    A transfer is only resumed when the first response advertised "Accept-Ranges: bytes" and a strong
+    validator (ETag or Last-Modified). The validator is kept in a sidecar file and sent as If-Range, so a
+    server that has rebuilt the archive sends it whole instead of a tail that does not match the prefix.
+
+    :param api: The reference to tha API object.
+    :param endpoint: The endpoint to download.
+    :param part_file: The partial file to write to.
+    :param timeout: The request timeout length in seconds.
+    :raises ValueError: When the server returns an error.
+    """
+    offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    state = read_part_state(part_file)
+
+    headers = None
+    if offset and state.get("accept_ranges") and state.get("validator"):
+        headers = {"Range": f"bytes={offset}-", "If-Range": state["validator"]}
+    elif offset:
+        logger.info(f"Range requests not supported, downloading '{part_file}' again.")
+
+    with api.get(endpoint=endpoint, timeout=timeout, headers=headers, stream=True) as res:
+        if headers and res.status_code == 416:
+            # The partial file may already hold the whole archive, e.g. the stream broke after the last byte.
+            if res.headers.get("Content-Range", "") == f"bytes */{offset}":
+                logger.info(f"'{part_file}' is already complete.")
+                return
+            # Otherwise the partial file does not match the server's content, start again straight away.
+            logger.info(f"Range not satisfiable for '{part_file}', downloading it again.")
+            remove_part(part_file)
+            return download_part(api, endpoint, part_file, timeout)
+
+        # If response is empty, let the user know.
+        if not res:
+            logger.error(f"No data in response.")
+            raise ValueError("Issue downloading images.")
+
+        if headers and res.status_code == 206:
+            if not res.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+                remove_part(part_file)
+                raise ValueError(f"Unexpected Content-Range '{res.headers.get('Content-Range')}' for '{part_file}'.")
+            logger.info(f"Resuming '{part_file}' from byte {offset}.")
+            mode = "ab"
+        else:
+            # A full response, remember how it can be resumed if this transfer breaks.
+            write_part_state(part_file, res.headers)
+            mode = "wb"
+
+        with open(part_file, mode) as stream:
+            for item in res.iter_content(chunk_size=1 << 16):
+                stream.write(item)
+
+
+def part_state_file(part_file: str) -> str:
+    """The sidecar file holding the resume state of a partial download."""
+    return f"{part_file}.json"
+
+
+def read_part_state(part_file: str) -> dict:
+    """
+    Reads the resume state of a partial download.
+
+    :param part_file: The partial file.
+    :return: The state recorded from the first response, empty if there is none.
+    """
+    try:
+        with open(part_state_file(part_file)) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_part_state(part_file: str, headers: dict) -> None:
+    """
+    Records whether a response can be resumed and the validator to resume it with.
+
+    :param part_file: The partial file.
+    :param headers: The headers of the full response.
+    """
+    etag = headers.get("ETag")
+    # Weak ETags cannot be used with If-Range.
+    validator = etag if etag and not etag.startswith("W/") else headers.get("Last-Modified")
+
+    with open(part_state_file(part_file), "w") as fh:
+        json.dump({"accept_ranges": headers.get("Accept-Ranges", "").lower() == "bytes", "validator": validator}, fh)
+
+
+def remove_part(part_file: str, keep_data: bool = False) -> None:
+    """
+    Removes a partial download and its resume state.
+
+    :param part_file: The partial file.
+    :param keep_data: Only remove the resume state.
+    """
+    paths = [part_state_file(part_file)] if keep_data else [part_file, part_state_file(part_file)]
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def remove_stale_parts(params: DownloadCommandParameters, keep_batches: List[List[str]]) -> None:
+    """
+    Removes partial downloads in the output directory that do not belong to the batches to keep.
+
+    :param params: The command line parameters.
+    :param keep_batches: The batches whose partial downloads can still be resumed.
+    """
+    keep = {f"{batch_file_name(params, batch)}.part" for batch in keep_batches}
+
+    for name in os.listdir(params.output):
+        part_file = os.path.join(params.output, name)
+        if name.endswith(".part") and part_file not in keep:
+            logger.info(f"Removing stale partial download '{part_file}'.")
+            remove_part(part_file)
+        elif name.endswith(".part.json") and not os.path.exists(part_file[:-len(".json")]) and os.path.exists(part_file):
+            # Orphaned resume state, unless it was already removed with its partial file above.
+            os.remove(part_file)
+
+
+def verify_archive(part_file: str) -> None:
+    """
+    Checks a finished download is a readable zip archive, discarding it otherwise.
+
+    :param part_file: The partial file.
+    :raises ValueError: When the archive is corrupt.
+    """
+    if zipfile.is_zipfile(part_file):
+        with zipfile.ZipFile(part_file) as zip_ref:
+            if zip_ref.testzip() is None:
+                return
+
+    remove_part(part_file)
+    raise ValueError(f"'{part_file}' is not a valid zip archive.")
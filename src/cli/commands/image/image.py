@@ -3,26 +3,33 @@ Author:     David Walshe
 Date:       12 February 2021
 """
 
+import csv
+import json
 import logging
+import sys
 from collections import namedtuple
+from itertools import islice
+from typing import Iterable, Iterator, TextIO
 
 import click
+import pandas as pd
 from click.core import Context
 
 from src.cli.config import GROUP_CONTEXT_SETTINGS
-from src.cli.utils import kwargs_to_namedtuple
+from src.cli.utils import kwargs_to_namedtuple, filter_dataframe, WhereExpressionError
 from src.cli.validators import convert_bool_to_lower
 
 # Commands
-from src.cli.commands.image.metadata import metadata
+from src.cli.commands.image.metadata import metadata, process_metadata
 from src.cli.commands.image.download import download
 from src.cli.commands.image.unzip import unzip
+from src.cli.commands.image.preprocess import preprocess
 
 from src.api.isic_api import IsicApi
 
 logger = logging.getLogger(__name__)
 
-ImageCommandParameters = namedtuple("ImageCommandParameters", ["limit", "offset", "sort", "desc", "detail", "name", "timeout"])
+ImageCommandParameters = namedtuple("ImageCommandParameters", ["limit", "offset", "sort", "desc", "detail", "name", "timeout", "format", "prefetch", "where"])
 
 
 @click.group(**GROUP_CONTEXT_SETTINGS, short_help="Downloads an image")
@@ -33,6 +40,9 @@ ImageCommandParameters = namedtuple("ImageCommandParameters", ["limit", "offset"
 @click.option("--detail", is_flag=True, callback=convert_bool_to_lower, help="Display the full information for each image, instead of a summary.")
 @click.option("--name", type=str, default="", help="Find an image with a specific name.")
 @click.option("--timeout", type=int, default=5, help="The request timeout length in seconds.")
+@click.option("--format", type=click.Choice(["ndjson", "csv"], case_sensitive=False), default="ndjson", help="The output format written to stdout. Default=ndjson")
+@click.option("--prefetch", type=int, default=4, help="The number of result pages to fetch ahead in the background. Default=4")
+@click.option("--where", type=str, default=None, help="Only list images whose metadata matches this expression, requires --detail. Uses the metadata command's column names.")
 # @click.option("-f", "--filter", type=str, default="", help="Filter the images by a PegJS-specified grammar.")
 @kwargs_to_namedtuple(ImageCommandParameters)
 @click.pass_context
@@ -41,21 +51,94 @@ def image(ctx: Context, params: ImageCommandParameters):
     Calls the "<api>/image" endpoint
     """
     if ctx.invoked_subcommand is None:
-        api = IsicApi()
+        api = IsicApi(pool_size=max(params.prefetch, 1))
 
-        endpoint = f"image?" \
-                   f"sort={params.sort}&" \
-                   f"sortdir={-1 if params.desc else 1}&" \
-                   f"detail={params.detail}"
+        endpoint = make_endpoint(params)
 
-        # Add name check if specified
-        endpoint += f"&name={params.name}" if params.name != "" else ""
+        if params.where is not None and params.detail != "true":
+            raise click.BadParameter("'--where' requires '--detail'.")
 
-        print(len(list(api.get_json_list(endpoint=endpoint, limit=params.limit, offset=params.offset, timeout=params.timeout))))
-        print(list(api.get_json_list(endpoint=endpoint, limit=params.limit, offset=params.offset, timeout=params.timeout)))
+        items = api.get_json_list(endpoint=endpoint, limit=params.limit, offset=params.offset, timeout=params.timeout, prefetch=params.prefetch)
+        items = filter_items(items, params.where, batch_size=params.limit)
+
+        try:
+            count = write_items(items, sys.stdout, params.format)
+        except WhereExpressionError as e:
+            raise click.BadParameter(str(e), param_hint="'--where'")
+
+        # Written to stderr to keep stdout machine readable.
+        click.echo(f"{count} images listed.", err=True)
+
+
+def make_endpoint(params: ImageCommandParameters) -> str:
+    """
+    Creates the "<api>/image" endpoint for the listing parameters.
+
+    :param params: The CLI parameters.
+    :return: The endpoint with its query string, excluding limit and offset.
+    """
+    endpoint = f"image?" \
+               f"sort={params.sort}&" \
+               f"sortdir={-1 if params.desc else 1}&" \
+               f"detail={params.detail}"
+
+    # Add name check if specified
+    endpoint += f"&name={params.name}" if params.name != "" else ""
+
+    return endpoint
+
+
+def filter_items(items: Iterable[dict], where: str, batch_size: int) -> Iterator[dict]:
+    """
+    Filters detailed API items by a --where expression, evaluated over batches of their flattened metadata.
+
+    :param items: The detailed items returned from the API.
+    :param where: A pandas query expression, None applies no filter.
+    :param batch_size: The number of items to evaluate the expression over at a time.
+    :return: The items matching the expression.
+    """
+    if where is None:
+        yield from items
+        return
+
+    items = iter(items)
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            break
+        df = filter_dataframe(pd.DataFrame([process_metadata(item) for item in batch]), where)
+        for index in df.index:
+            yield batch[index]
+
+
+def write_items(items: Iterable[dict], stream: TextIO, fmt: str) -> int:
+    """
+    Streams the API items to a text stream as they arrive.
+
+    :param items: The items returned from the API.
+    :param stream: The stream to write the items to.
+    :param fmt: The output format, either "ndjson" or "csv".
+    :return: The number of items written.
+    """
+    count = 0
+    writer = None
+
+    for item in items:
+        if fmt == "csv":
+            # The header is taken from the first item, nested values are kept as JSON.
+            if writer is None:
+                writer = csv.DictWriter(stream, fieldnames=list(item.keys()), extrasaction="ignore")
+                writer.writeheader()
+            writer.writerow({key: json.dumps(value) if isinstance(value, (dict, list)) else value for key, value in item.items()})
+        else:
+            stream.write(json.dumps(item))
+            stream.write("\n")
+        count += 1
+
+    stream.flush()
+
+    return count
 
-        # for item in api.get_json_list(endpoint=endpoint, limit=params.limit, offset=params.offset):
-        #     print(item)
 
 # ==================================================
 # Add CLI commands
@@ -63,7 +146,8 @@ def image(ctx: Context, params: ImageCommandParameters):
 commands = [
     metadata,
     download,
-    unzip
+    unzip,
+    preprocess
 ]
 
 for command in commands:
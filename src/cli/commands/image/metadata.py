@@ -9,20 +9,20 @@ import json
 import pprint
 from time import sleep
 from collections import namedtuple, OrderedDict
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Union, List, Tuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Any, Callable, Union, List, Sequence, Tuple
 
 import click
 import pandas as pd
 from alive_progress import alive_bar
 
-from src.api.isic_api import IsicApi
-from src.cli.config import COMMAND_CONTEXT_SETTINGS
-from src.cli.utils import kwargs_to_namedtuple
+from src.api.isic_api import IsicApi, decode_json
+from src.cli.config import COMMAND_CONTEXT_SETTINGS, IN_FLIGHT_PER_WORKER
+from src.cli.utils import kwargs_to_namedtuple, submit_bounded
 
 logger = logging.getLogger(__name__)
 
-MetadataCommandParameters = namedtuple("MetadataCommandParameters", ["output", "retry", "timeout", "limit", "offset", "batch_size", "workers"])
+MetadataCommandParameters = namedtuple("MetadataCommandParameters", ["output", "retry", "timeout", "limit", "offset", "batch_size", "workers", "parse_workers"])
 
 
 @click.command(**COMMAND_CONTEXT_SETTINGS, short_help="Download metadata for a list of images.")
@@ -33,6 +33,7 @@ MetadataCommandParameters = namedtuple("MetadataCommandParameters", ["output", "
 @click.option("--retry", is_flag=True, help="Tries to download the missing records from a previous attempt.")
 @click.option("--timeout", type=int, default=5, help="The timeout length for each request to the API. Default=5")
 @click.option("-w", "--workers", type=int, default=5, help=f"Specify how many concurrent workers should be used. Default=5")
+@click.option("--parse-workers", type=int, default=0, help=f"Decode and flatten responses in a pool of this many processes. Default=0 (parse on the download workers)")
 @kwargs_to_namedtuple(MetadataCommandParameters)
 def metadata(params: MetadataCommandParameters):
     """
@@ -54,7 +55,7 @@ def metadata(params: MetadataCommandParameters):
         df.to_csv(params.output, index=True)
 
 
-def get_offsets(params: MetadataCommandParameters) -> List[int]:
+def get_offsets(params: MetadataCommandParameters) -> Sequence[int]:
     """
     Gets the offset ranges for the requests.
 
@@ -67,39 +68,50 @@ def get_offsets(params: MetadataCommandParameters) -> List[int]:
         with open(src_file) as fh:
             return json.load(fh)
     else:
-        return [i for i in range(params.offset, params.limit, params.batch_size)]
+        return range(params.offset, params.limit, params.batch_size)
 
 
-def download_metadata(params: MetadataCommandParameters) -> Tuple[List[dict], List[str]]:
+def download_metadata(params: MetadataCommandParameters, api: IsicApi = None) -> Tuple[List[dict], List[str]]:
     """
     Uses a thread pool to download image metadata concurrently.
 
+    :param params: The CLI parameters.
+    :param api: The API client to reuse, a new one is created if not passed.
     :return: The tuple of metadata results and names of images that failed to download.
     """
-    api = IsicApi()
+    api = api if api is not None else IsicApi()
+    api.resize_pool(params.workers)
     results = []
     errors = []
 
     offsets = get_offsets(params=params)
 
-    # Measure the download progress for the full dataset.
-    with alive_bar(len(offsets), title="Total Progress", enrich_print=False) as total_bar:
-        # Run concurrent workers to download metadata.
-        with ThreadPoolExecutor(max_workers=params.workers) as executor:
-            future_to_request = {executor.submit(make_request, api, params.batch_size, offset, params.timeout): offset for offset in offsets}
-
-            for future in as_completed(future_to_request):
-                offset = future_to_request[future]
-                try:
-                    res = future.result()
-                    if not res:
-                        logger.error(f"No data in response.")
-                    else:
-                        results = [*results, *res]
-                    total_bar()
-                except Exception as e:
-                    logger.info(f"{e}")
-                    errors.append(offset)
+    # Parse responses off the download threads when a process pool is requested.
+    parse_pool = ProcessPoolExecutor(max_workers=params.parse_workers) if params.parse_workers > 0 else None
+
+    try:
+        # Measure the download progress for the full dataset.
+        with alive_bar(len(offsets), title="Total Progress", enrich_print=False) as total_bar:
+            # Run concurrent workers to download metadata.
+            with ThreadPoolExecutor(max_workers=params.workers) as executor:
+                # Bound the requests in flight, each worker waits on its own parse task.
+                completed = submit_bounded(executor, lambda offset: make_request(api, params.batch_size, offset, params.timeout, parse_pool),
+                                           offsets, IN_FLIGHT_PER_WORKER * params.workers)
+
+                for offset, future in completed:
+                    try:
+                        res = future.result()
+                        if not res:
+                            logger.error(f"No data in response.")
+                        else:
+                            results.extend(res)
+                        total_bar()
+                    except Exception as e:
+                        logger.info(f"{e}")
+                        errors.append(offset)
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown()
 
     return results, errors
 
@@ -139,7 +151,7 @@ def process_results(params: MetadataCommandParameters, results: List[dict]) -> U
         raise e
 
 
-def make_request(api: IsicApi, limit: int, offset: int, timeout: int) -> Union[List[dict], None]:
+def make_request(api: IsicApi, limit: int, offset: int, timeout: int, parse_pool: ProcessPoolExecutor = None) -> Union[List[dict], None]:
     """
     Make a metadata request to the API.
 
@@ -147,12 +159,30 @@ def make_request(api: IsicApi, limit: int, offset: int, timeout: int) -> Union[L
     :param limit: The image name to retrieve data on.
     :param offset: The image name to retrieve data on.
     :param timeout: Timeout in seconds.
+    :param parse_pool: A process pool to decode and flatten the response in, otherwise it is parsed on this thread.
+                       The API's decoder is sent to the pool, so it must be picklable, i.e. a module-level function.
     :return: The data on the image or None.
     """
     endpoint = f"image?" \
                f"detail=true"
 
-    res = api.get_json(endpoint=endpoint, limit=limit, offset=offset, timeout=timeout)
+    content = api.get_raw(endpoint=endpoint, limit=limit, offset=offset, timeout=timeout)
+
+    if parse_pool is not None:
+        return parse_pool.submit(parse_metadata, content, api.decode).result()
+
+    return parse_metadata(content, decoder=api.decode)
+
+
+def parse_metadata(content: bytes, decoder: Callable[[bytes], Any] = decode_json) -> Union[List[dict], None]:
+    """
+    Decodes and flattens a raw metadata response, suitable for running in a process pool.
+
+    :param content: The raw response body.
+    :param decoder: The JSON decoder to use, picklable (a module-level function) when run in a process pool.
+    :return: The data on the images or None.
+    """
+    res = decoder(content)
 
     if not res:
         logger.error(f"No data available.")
@@ -186,5 +216,5 @@ def process_metadata(data: dict) -> OrderedDict:
             melanocytic=data["meta"]["clinical"].get("melanocytic", None),
         )
     except Exception as e:
-        pprint.pprint(data)
+        logger.error(f"Unable to process metadata for item: {data}")
         raise e
@@ -0,0 +1,241 @@
+"""
+Author:     David Walshe
+Date:       23 February 2021
+"""
+
+import io
+import os
+import logging
+from zipfile import ZipFile
+from collections import namedtuple
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter, process_time
+from typing import Dict, List, Tuple
+
+import click
+import pandas as pd
+from PIL import Image
+from alive_progress import alive_bar
+
+from src.cli.config import COMMAND_CONTEXT_SETTINGS, IN_FLIGHT_PER_WORKER
+from src.cli.utils import kwargs_to_namedtuple, submit_bounded, make_temp_file
+from src.cli.validators import check_file_exists
+from src.cli.commands.image.unzip import sharded_path
+from src.cli.commands.image.download import BYTES_PER_PIXEL
+
+logger = logging.getLogger(__name__)
+
+PreprocessCommandParameters = namedtuple("PreprocessCommandParameters", ["input", "metadata_file", "output", "size", "format", "quality", "layout", "workers"])
+
+# An image to process: (file or archive path, archive member or None, source modification time, scheduling weight).
+ImageTask = Tuple[str, str, float, int]
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+FORMAT_EXTENSIONS = {
+    "jpeg": ".jpg",
+    "png": ".png",
+    "webp": ".webp"
+}
+
+
+@click.command(**COMMAND_CONTEXT_SETTINGS, short_help="Resizes and re-encodes downloaded images.")
+@click.option("-i", "--input", type=str, required=True, callback=check_file_exists, help="The directory of downloaded archives or extracted images.")
+@click.option("--metadata-file", type=str, default=None, callback=check_file_exists, help="The previously downloaded metadata file, used to schedule the largest images first.")
+@click.option("-o", "--output", type=str, default="./isic_images_preprocessed", help="The directory to save the images to, with one subdirectory per size.")
+@click.option("-s", "--size", type=int, multiple=True, default=[224], help="The maximum width and height of the output images, can be repeated. Default=224")
+@click.option("--format", type=click.Choice(list(FORMAT_EXTENSIONS), case_sensitive=False), default="jpeg", help="The output image format. Default=jpeg")
+@click.option("--quality", type=int, default=90, help="The output quality for lossy formats. Default=90")
+@click.option("--layout", type=click.Choice(["flat", "sharded"], case_sensitive=False), default="flat",
+              help="'flat' places all images of a size in one directory, 'sharded' uses the same subdirectories as 'image unzip --layout sharded'. Default=flat")
+@click.option("-w", "--workers", type=int, default=os.cpu_count(), help=f"Specify how many worker processes should be used. Default={os.cpu_count()}")
+@kwargs_to_namedtuple(PreprocessCommandParameters)
+def preprocess(params: PreprocessCommandParameters):
+    """
+    Resizes and re-encodes downloaded images using a process pool.
+    """
+    preprocess_images(params)
+
+
+def preprocess_images(params: PreprocessCommandParameters) -> None:
+    """
+    Uses a process pool to resize images concurrently, largest images first.
+
+    :param params: The CLI parameters.
+    """
+    tasks = find_images(params)
+
+    # Only process images with missing or stale outputs.
+    tasks = [task for task in tasks if not all(is_up_to_date(target_path(params, size, task), task[2]) for size in params.size)]
+    logger.info(f"{len(tasks)} images to preprocess.")
+
+    if not tasks:
+        return
+
+    # Start the most expensive images first to shorten the tail of the run.
+    tasks = schedule_images(params, tasks)
+
+    processed = 0
+    cpu_time = 0.0
+    start_time = perf_counter()
+
+    with alive_bar(len(tasks), title="Total Progress", enrich_print=False) as total_bar:
+        with ProcessPoolExecutor(max_workers=params.workers) as executor:
+            completed = submit_bounded(executor, partial(preprocess_image, params=params), tasks, IN_FLIGHT_PER_WORKER * params.workers)
+            for task, future in completed:
+                try:
+                    _, task_cpu_time = future.result()
+                    processed += 1
+                    cpu_time += task_cpu_time
+                    total_bar()
+                except Exception as e:
+                    logger.error(f"{e}")
+                    logger.error(f"{task[0]}:{task[1]}" if task[1] else f"{task[0]}")
+
+    elapsed = perf_counter() - start_time
+    logger.info(f"Preprocessed {processed} images in {elapsed:.2f}s: {processed / elapsed:.2f} images/s, "
+                f"{processed / elapsed / params.workers:.2f} images/s per core ({processed / max(cpu_time, 1e-9):.2f} images per CPU second).")
+
+
+def find_images(params: PreprocessCommandParameters) -> List[ImageTask]:
+    """
+    Finds the images in the input, both inside zip archives and as extracted files.
+
+    Images found more than once, e.g. in several archives, share their output files so only the newest copy is kept.
+
+    :param params: The CLI parameters.
+    :return: The images found, weighted by their file size.
+    """
+    if os.path.isfile(params.input):
+        paths = [params.input]
+    else:
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(params.input) for name in names)
+
+    output = os.path.join(os.path.abspath(params.output), "")
+
+    tasks = []
+    for path in paths:
+        if path.endswith(".zip"):
+            mtime = os.path.getmtime(path)
+            with ZipFile(path, 'r') as zip_ref:
+                tasks.extend((path, member.filename, mtime, member.file_size) for member in zip_ref.infolist()
+                             if member.filename.lower().endswith(IMAGE_EXTENSIONS))
+        elif path.lower().endswith(IMAGE_EXTENSIONS) and not os.path.abspath(path).startswith(output):
+            tasks.append((path, None, os.path.getmtime(path), os.path.getsize(path)))
+
+    images = {}
+    for task in tasks:
+        name = image_name(task[0], task[1])
+        if name not in images or task[2] > images[name][2]:
+            images[name] = task
+
+    if len(images) < len(tasks):
+        logger.info(f"{len(tasks) - len(images)} duplicate images skipped.")
+
+    return list(images.values())
+
+
+def schedule_images(params: PreprocessCommandParameters, tasks: List[ImageTask]) -> List[ImageTask]:
+    """
+    Orders the images largest first, by pixel count when a metadata file is given and file size otherwise.
+
+    :param params: The CLI parameters.
+    :param tasks: The images to process.
+    :return: The images in the order to process them.
+    """
+    if params.metadata_file is not None:
+        pixels = get_image_pixels(params.metadata_file)
+        # Pixel counts are scaled to bytes so images missing from the metadata can be compared by file size.
+        tasks = [(source, member, mtime, int(pixels[image_name(source, member)] * BYTES_PER_PIXEL) if image_name(source, member) in pixels else weight)
+                 for source, member, mtime, weight in tasks]
+
+    return sorted(tasks, key=lambda task: task[3], reverse=True)
+
+
+def get_image_pixels(metadata_file: str) -> Dict[str, float]:
+    """
+    Reads the pixel count of each image from the metadata file.
+
+    :param metadata_file: The previously downloaded metadata file.
+    :return: The pixel count of each image, keyed by image name.
+    """
+    df = pd.read_csv(metadata_file, usecols=["image_name", "pixels_x", "pixels_y"]).dropna()
+
+    return dict(zip(df["image_name"], df["pixels_x"] * df["pixels_y"]))
+
+
+def image_name(source: str, member: str = None) -> str:
+    """
+    The image name of a file, e.g. "ISIC-images/HAM10000/ISIC_0024306.jpg" -> "ISIC_0024306".
+    """
+    return os.path.splitext(os.path.basename(member or source))[0]
+
+
+def target_path(params: PreprocessCommandParameters, size: int, task: ImageTask) -> str:
+    """
+    The output path of an image at a given size.
+
+    :param params: The CLI parameters.
+    :param size: The output size.
+    :param task: The image to process.
+    :return: The path to save the image to.
+    """
+    root = os.path.join(params.output, str(size))
+    filename = f"{image_name(task[0], task[1])}{FORMAT_EXTENSIONS[params.format]}"
+
+    return sharded_path(root, filename) if params.layout == "sharded" else os.path.join(root, filename)
+
+
+def is_up_to_date(target: str, mtime: float) -> bool:
+    """
+    Checks if an output file exists and is newer than its source.
+    """
+    return os.path.exists(target) and os.path.getmtime(target) >= mtime
+
+
+def preprocess_image(task: ImageTask, params: PreprocessCommandParameters) -> Tuple[int, float]:
+    """
+    Decodes an image once and saves it at each missing or stale size, run in a worker process.
+
+    :param task: The image to process.
+    :param params: The CLI parameters.
+    :return: The number of images written and the CPU time taken.
+    """
+    start_time = process_time()
+    source, member, mtime, _ = task
+
+    if member is None:
+        with open(source, "rb") as fh:
+            data = fh.read()
+    else:
+        with ZipFile(source, 'r') as zip_ref:
+            data = zip_ref.read(member)
+
+    image = Image.open(io.BytesIO(data))
+    # Let the JPEG decoder downscale while decoding, it never goes below the requested size.
+    image.draft("RGB", (max(params.size), max(params.size)))
+    image = image.convert("RGB")
+
+    written = 0
+    # Resize largest first so each size is derived from the previous one.
+    for size in sorted(set(params.size), reverse=True):
+        image.thumbnail((size, size), Image.LANCZOS)
+
+        target = target_path(params, size, task)
+        if is_up_to_date(target, mtime):
+            continue
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Write to a temporary file so a partial image is never mistaken for an up-to-date one.
+        fd, temp_target = make_temp_file(os.path.dirname(target))
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                image.save(fh, format=params.format.upper(), quality=params.quality)
+            os.replace(temp_target, target)
+        except Exception as e:
+            os.remove(temp_target)
+            raise e
+        written += 1
+
+    return written, process_time() - start_time
@@ -4,27 +4,39 @@ Date:       23 February 2021
 """
 
 import os
+import re
+import shutil
+import hashlib
 import logging
-from zipfile import ZipFile
+import threading
+from zipfile import ZipFile, ZipInfo
 from collections import namedtuple
-from concurrent.futures import ThreadPoolExecutor, as_completed, Future
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 from alive_progress import alive_bar
 
-from src.cli.config import COMMAND_CONTEXT_SETTINGS
-from src.cli.utils import kwargs_to_namedtuple
+from src.cli.config import COMMAND_CONTEXT_SETTINGS, IN_FLIGHT_PER_WORKER
+from src.cli.utils import kwargs_to_namedtuple, submit_bounded, make_temp_file
 from src.cli.validators import check_file_exists
 
 logger = logging.getLogger(__name__)
 
-UnzipCommandParameters = namedtuple("UnzipCommandParameter", ["zip_dir", "output", "workers"])
+# Members named after an ISIC image, e.g. "ISIC_0000000.jpg" or its "ISIC_0000000.json" metadata, are sharded.
+SHARDED_NAME = re.compile(r"^ISIC_\d+$")
+
+# Guards the record of sharded files extracted by concurrent workers.
+extracted_lock = threading.Lock()
+
+UnzipCommandParameters = namedtuple("UnzipCommandParameter", ["zip_dir", "output", "workers", "layout"])
 
 
 @click.command(**COMMAND_CONTEXT_SETTINGS, short_help="Unzips and collects all images into a single directory.")
 @click.option("--zip-dir", type=str, required=True, callback=check_file_exists, help="The previously downloaded metadata file.")
 @click.option("-o", "--output", type=str, default=os.path.abspath("./isic_images_extracted"), help="The name of the directory to collect images to after unzipping.")
 @click.option("-w", "--workers", type=int, default=5, help=f"Specify how many concurrent workers should be used. Default=5")
+@click.option("--layout", type=click.Choice(["flat", "sharded"], case_sensitive=False), default="flat",
+              help="'flat' keeps the archive structure, 'sharded' places each ISIC image in a subdirectory derived from a hash of its name. Default=flat")
 @kwargs_to_namedtuple(UnzipCommandParameters)
 def unzip(params: UnzipCommandParameters):
     """
@@ -57,8 +69,11 @@ def unzip_images(params: UnzipCommandParameters):
     zip_archives = [os.path.abspath(os.path.join(params.zip_dir, archive)) for archive in os.listdir(params.zip_dir) if archive.endswith(".zip")]
     num_archives = len(zip_archives)
 
+    # Sharded files written so far, to report name collisions.
+    extracted = set()
+
     # First archive is done sequentially to stop OSErrors when creating file structures for datasets.
-    unzip_archive(zip_archives.pop(), params)
+    unzip_archive(zip_archives.pop(), params, extracted)
 
     # Measure the download progress for the full dataset.
     with alive_bar(num_archives, title="Total Progress", enrich_print=False) as total_bar:
@@ -67,22 +82,83 @@ def unzip_images(params: UnzipCommandParameters):
         # Run concurrent workers to download ìmages.
         with ThreadPoolExecutor(max_workers=params.workers) as executor:
             # Create a worker with a set of images to request and download.
-            futures_to_request = {executor.submit(unzip_archive, archive, params): archive for batch_idx, archive in enumerate(zip_archives)}
-            for index, future in enumerate(as_completed(futures_to_request)):
+            completed = submit_bounded(executor, lambda archive: unzip_archive(archive, params, extracted), zip_archives, IN_FLIGHT_PER_WORKER * params.workers)
+            for archive, future in completed:
                 try:
                     future.result()
                     total_bar()
                 except Exception as e:
                     logger.error(f"{e}")
-                    logger.error(f"{futures_to_request[future]}")
+                    logger.error(f"{archive}")
 
 
-def unzip_archive(archive: str, params: UnzipCommandParameters) -> None:
+def unzip_archive(archive: str, params: UnzipCommandParameters, extracted: set = None) -> None:
     """
     Unzip archive and place contents into output directory.
 
     :param archive: The archive to read data from.
     :param params: The CLI parameters.
+    :param extracted: The sharded files written so far, shared between workers to report name collisions.
     """
     with ZipFile(archive, 'r') as zip_ref:
-        zip_ref.extractall(params.output)
+        if params.layout == "sharded":
+            for member in zip_ref.infolist():
+                extract_sharded(zip_ref, member, params.output, extracted if extracted is not None else set())
+        else:
+            zip_ref.extractall(params.output)
+
+
+def extract_sharded(zip_ref: ZipFile, member: ZipInfo, output: str, extracted: set) -> None:
+    """
+    Extracts a single archive member for '--layout sharded'.
+
+    Files named after an ISIC image go into their shard directory, other files such as licenses keep
+    their path within the archive.
+
+    :param zip_ref: The open archive.
+    :param member: The member to extract.
+    :param output: The root of the sharded output directory.
+    :param extracted: The sharded files written so far.
+    """
+    if member.is_dir():
+        return
+
+    filename = os.path.basename(member.filename)
+    if SHARDED_NAME.match(os.path.splitext(filename)[0]):
+        target = sharded_path(output, filename)
+        with extracted_lock:
+            if target in extracted:
+                logger.warning(f"'{member.filename}' in '{zip_ref.filename}' overwrites an earlier file at '{target}'.")
+            extracted.add(target)
+    else:
+        # Drop unsafe path components, as extractall does.
+        target = os.path.join(output, *[part for part in member.filename.split("/") if part not in ("", ".", "..")])
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    # Write to a temporary file so concurrent workers never interleave their output.
+    fd, temp_target = make_temp_file(os.path.dirname(target))
+    try:
+        with zip_ref.open(member) as src, os.fdopen(fd, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(temp_target, target)
+    except Exception as e:
+        os.remove(temp_target)
+        raise e
+
+
+def sharded_path(root: str, filename: str) -> str:
+    """
+    Resolves where a file is placed by '--layout sharded', without listing any directories.
+
+    The shard is the first two hex digits of the MD5 of the file's name without its extension,
+    so an image and its metadata file share a shard, e.g. "ISIC_0000000.jpg" -> "<root>/<shard>/ISIC_0000000.jpg".
+
+    :param root: The root of the sharded output directory.
+    :param filename: The file name, e.g. "ISIC_0000000.jpg".
+    :return: The path of the file.
+    """
+    stem = os.path.splitext(filename)[0]
+    shard = hashlib.md5(stem.encode("utf-8")).hexdigest()[:2]
+
+    return os.path.join(root, shard, filename)
@@ -15,4 +15,10 @@ COMMAND_CONTEXT_SETTINGS = {
 GROUP_CONTEXT_SETTINGS = {
     **COMMAND_CONTEXT_SETTINGS,
     "invoke_without_command": True
-}
\ No newline at end of file
+}
+
+# ===========================================================
+# Executor Options
+# ===========================================================
+# The number of tasks allowed in flight, or holding results, per worker.
+IN_FLIGHT_PER_WORKER = 2
@@ -4,11 +4,37 @@ Date:       12 February 2021
 """
 
 import logging
+import os
+import re
+import tempfile
+from concurrent.futures import Executor, Future, FIRST_COMPLETED, wait
 from functools import wraps
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
+
+import pandas as pd
 
 logger = logging.getLogger(__name__)
 
 
+def get_umask() -> int:
+    """
+    Reads the process umask, which can only be done by setting it.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+
+    return umask
+
+
+# The mode open() gives new files, read once as changing the umask is not thread safe.
+FILE_MODE = 0o666 & ~get_umask()
+
+
+class WhereExpressionError(ValueError):
+    """Raised when a --where expression cannot be used to filter metadata."""
+
+
 def kwargs_to_namedtuple(named_tuple):
     """
     Converts a click commands kwargs into a named Tuple.
@@ -26,3 +52,104 @@ def kwargs_to_namedtuple(named_tuple):
         return _kwargs_to_namedtuple_wrapper
 
     return _kwargs_to_namedtuple
+
+
+def submit_bounded(executor: Executor, fn: Callable[[Any], Any], items: Iterable[Any], max_in_flight: int) -> Iterator[Tuple[Any, Future]]:
+    """
+    Submits work to an executor lazily, keeping at most max_in_flight tasks running or holding results.
+
+    New items are only pulled from the iterable as completed tasks are handed back, so memory stays flat no
+    matter how many items there are. Tasks that have not started are cancelled if the generator is closed early.
+
+    :param executor: The executor to run the tasks on.
+    :param fn: The function to call with each item.
+    :param items: The items to process, may be a lazy generator.
+    :param max_in_flight: The maximum number of tasks submitted but not yet handed back.
+    :return: A generator of (item, future) pairs in completion order.
+    """
+    items = iter(items)
+    in_flight = {executor.submit(fn, item): item for item in islice(items, max(max_in_flight, 1))}
+
+    try:
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield in_flight.pop(future), future
+                # Replace the task handed back.
+                for item in islice(items, 1):
+                    in_flight[executor.submit(fn, item)] = item
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+def make_temp_file(directory: str) -> Tuple[int, str]:
+    """
+    Creates a uniquely named temporary file to write to and then move into place with os.replace.
+
+    mkstemp creates files readable only by their owner, so the file is given the mode open() would have used.
+
+    :param directory: The directory of the final file, so the replace stays on one filesystem.
+    :return: The open file descriptor and path of the temporary file.
+    """
+    fd, temp_file = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    os.chmod(temp_file, FILE_MODE)
+
+    return fd, temp_file
+
+
+def where_columns(where: str, columns: Iterable[str]) -> List[str]:
+    """
+    Finds the columns referenced by a --where expression.
+
+    :param where: A pandas query expression, e.g. "benign_malignant == 'malignant' and pixels_x >= 1024".
+    :param columns: The available column names.
+    :return: The subset of columns used in the expression.
+    """
+    names = set(re.findall(r"`([^`]+)`|([A-Za-z_][A-Za-z0-9_]*)", where))
+    names = {backticked or plain for backticked, plain in names}
+
+    return [column for column in columns if column in names]
+
+
+def filter_dataframe(df: pd.DataFrame, where: str) -> pd.DataFrame:
+    """
+    Applies a --where expression to a DataFrame.
+
+    :param df: The DataFrame to filter.
+    :param where: A pandas query expression, None applies no filter.
+    :return: The rows matching the expression.
+    :raise WhereExpressionError: If the expression cannot be evaluated.
+    """
+    if where is None or df.empty:
+        return df
+
+    try:
+        mask = df.eval(where)
+    except Exception as e:
+        raise WhereExpressionError(f"'{where}' could not be evaluated: {e}")
+
+    if not isinstance(mask, pd.Series) or mask.dtype != bool:
+        raise WhereExpressionError(f"'{where}' is not a boolean expression.")
+
+    return df[mask]
+
+
+def read_metadata(metadata_file: str, columns: List[str], where: str = None) -> pd.DataFrame:
+    """
+    Reads a metadata file, loading only the requested columns and those used by the --where expression.
+
+    :param metadata_file: The previously downloaded metadata file.
+    :param columns: The columns required by the caller.
+    :param where: A pandas query expression to filter the rows by.
+    :return: The filtered metadata.
+    """
+    usecols = list(columns)
+
+    if where is not None:
+        header = pd.read_csv(metadata_file, nrows=0).columns
+        usecols += [column for column in where_columns(where, header) if column not in usecols]
+
+    df = pd.read_csv(metadata_file, usecols=usecols)
+
+    return filter_dataframe(df, where)
@@ -24,11 +24,11 @@ def convert_bool_to_lower(ctx, param, value: bool) -> str:
 
 def check_file_exists(ctx, param, value: str) -> str:
     """
-    Check if the file passed as a parameter exists on the filesystem.
+    Check if the file passed as a parameter exists on the filesystem, optional parameters left unset are accepted.
 
     :raise BadParameter: If passed parameter does not exist.
     """
-    if os.path.exists(value):
+    if value is None or os.path.exists(value):
         return value
     else:
         raise click.BadParameter(f"'{value}' for parameter '--{param.name}' does not exist.")
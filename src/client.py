@@ -0,0 +1,184 @@
+"""
+Author:     David Walshe
+Date:       12 February 2021
+
+High level Python interface to the ISIC archive, for use without the CLI.
+
+Example:
+
+    from src.client import IsicClient
+
+    client = IsicClient()
+    df = client.metadata(limit=1000)
+    failed = client.download_images(df[df["dataset"] == "HAM10000"].index, output="./isic_images", metadata=df)
+    failed = client.download_images(batches=failed, output="./isic_images", metadata=df)
+    client.unzip_images("./isic_images", output="./isic_images_extracted")
+"""
+
+import os
+import logging
+from collections import OrderedDict
+from queue import Queue
+from itertools import chain
+from typing import Iterable, Iterator, List
+
+import pandas as pd
+
+from src.api.isic_api import IsicApi
+from src.cli.commands.image.image import ImageCommandParameters, make_endpoint, filter_items
+from src.cli.commands.image.metadata import MetadataCommandParameters, download_metadata, process_results, process_metadata
+from src.cli.commands.image.download import DownloadCommandParameters, create_download_path, download_images, estimate_image_sizes
+from src.cli.commands.image.preprocess import PreprocessCommandParameters, preprocess_images
+from src.cli.commands.image.unzip import UnzipCommandParameters, create_extraction_path, unzip_images, sharded_path
+
+logger = logging.getLogger(__name__)
+
+
+class IsicClient(object):
+    """
+    Wraps the image commands, sharing one API client and its connection pool across calls.
+    """
+
+    def __init__(self, api: IsicApi = None, pool_size: int = 10, **api_kwargs):
+        """
+        :param api: The API client to use, a new one is created from api_kwargs if not passed.
+        :param pool_size: The initial connection pool size, grown to the workers or prefetch depth of each call.
+        :param api_kwargs: Keyword arguments passed to IsicApi.
+        """
+        self.api = api if api is not None else IsicApi(pool_size=pool_size, **api_kwargs)
+        self.api.resize_pool(pool_size)
+
+    def images(self, page_size: int = 50, offset: int = 0, sort: str = "name", desc: bool = False,
+               detail: bool = False, name: str = "", timeout: int = 5, prefetch: int = 4, where: str = None) -> Iterator[dict]:
+        """
+        Lists images from the "<api>/image" endpoint.
+
+        :param page_size: The number of images requested per page.
+        :param offset: Offset into result set.
+        :param sort: Field to sort the result set by.
+        :param desc: Sort in descending order.
+        :param detail: Return the full information for each image, instead of a summary.
+        :param name: Find an image with a specific name.
+        :param timeout: The request timeout length in seconds.
+        :param prefetch: The number of result pages to fetch ahead in the background.
+        :param where: Only return images whose flattened metadata matches this expression, requires detail.
+        :return: A generator of the raw API items.
+        :raises WhereExpressionError: A ValueError raised while iterating when where cannot be evaluated.
+        """
+        if where is not None and not detail:
+            raise ValueError("'where' requires 'detail'.")
+
+        params = ImageCommandParameters(limit=page_size, offset=offset, sort=sort, desc=desc, detail=str(detail).lower(),
+                                        name=name, timeout=timeout, format=None, prefetch=prefetch, where=where)
+
+        self.api.resize_pool(prefetch)
+
+        items = self.api.get_json_list(endpoint=make_endpoint(params), limit=page_size, offset=offset, timeout=timeout, prefetch=prefetch)
+
+        return filter_items(items, where, batch_size=page_size)
+
+    def iter_metadata(self, page_size: int = 100, offset: int = 0, timeout: int = 5, prefetch: int = 4) -> Iterator[OrderedDict]:
+        """
+        Streams the flattened metadata of each image, in the same format as the metadata command.
+
+        :param page_size: The number of images requested per page.
+        :param offset: Offset into result set.
+        :param timeout: The request timeout length in seconds.
+        :param prefetch: The number of result pages to fetch ahead in the background.
+        :return: A generator of metadata records.
+        """
+        for item in self.images(page_size=page_size, offset=offset, detail=True, timeout=timeout, prefetch=prefetch):
+            yield process_metadata(item)
+
+    def metadata(self, limit: int = 500, offset: int = 0, batch_size: int = 100, timeout: int = 5,
+                 workers: int = 5, parse_workers: int = 0) -> pd.DataFrame:
+        """
+        Downloads image metadata concurrently.
+
+        :param limit: Result set size limit.
+        :param offset: Offset into result set.
+        :param batch_size: The request batch size.
+        :param timeout: The timeout length for each request to the API.
+        :param workers: How many concurrent workers should be used.
+        :param parse_workers: Decode and flatten responses in a pool of this many processes.
+        :return: A DataFrame of the metadata indexed by isic_id.
+        """
+        params = MetadataCommandParameters(output=None, retry=False, timeout=timeout, limit=limit, offset=offset,
+                                           batch_size=batch_size, workers=workers, parse_workers=parse_workers)
+
+        results, errors = download_metadata(params, api=self.api)
+
+        if errors:
+            logger.error(f"{len(errors)} batches were not downloaded, offsets: {errors}")
+
+        df = process_results(params, results)
+
+        return df if df is not None else pd.DataFrame()
+
+    def download_images(self, image_ids: Iterable[str] = None, output: str = "./isic_images", include: str = "images",
+                        timeout: int = 60, workers: int = 5, metadata: pd.DataFrame = None, attempts: int = 3,
+                        batches: Iterable[List[str]] = None) -> List[List[str]]:
+        """
+        Downloads images as zip archives into the output directory.
+
+        :param image_ids: The ISIC image ids to download, e.g. the index of the metadata DataFrame.
+        :param output: The directory to save the archives to.
+        :param include: Which content to include, one of "all", "images" or "metadata".
+        :param timeout: The timeout length for each request to the API.
+        :param workers: How many concurrent workers should be used.
+        :param metadata: The metadata DataFrame indexed by isic_id, used to balance the batches by image size.
+        :param attempts: How many times to try each batch, resuming partial transfers where the server allows it.
+        :param batches: Failed batches returned by a previous call, downloaded whole instead of image_ids so their partial transfers resume.
+        :return: The batches of image ids that failed to download.
+        """
+        params = DownloadCommandParameters(metadata_file=None, dataset=None, include=include, output=output,
+                                           retry=False, timeout=timeout, workers=workers, where=None, attempts=attempts)
+
+        create_download_path(params)
+
+        batches = [list(batch) for batch in batches] if batches is not None else None
+        image_ids = list(chain.from_iterable(batches)) if batches is not None else list(image_ids)
+        image_sizes = estimate_image_sizes(metadata if metadata is not None else pd.DataFrame(), image_ids)
+
+        error_queue = Queue()
+        download_images(params, error_queue, api=self.api, image_ids=image_ids, image_sizes=image_sizes, image_batches=batches)
+
+        failed_batches = []
+        while not error_queue.empty():
+            failed_batches.append(error_queue.get())
+
+        return failed_batches
+
+    def unzip_images(self, zip_dir: str, output: str = "./isic_images_extracted", workers: int = 5, layout: str = "flat") -> None:
+        """
+        Unzips and collects all images into a single directory.
+
+        :param zip_dir: The directory of previously downloaded archives.
+        :param output: The directory to collect images to.
+        :param workers: How many concurrent workers should be used.
+        :param layout: "flat" keeps the archive structure, "sharded" places files as resolved by sharded_path.
+        """
+        params = UnzipCommandParameters(zip_dir=zip_dir, output=output, workers=workers, layout=layout)
+
+        create_extraction_path(params)
+        unzip_images(params)
+
+    def preprocess_images(self, input: str, output: str = "./isic_images_preprocessed", sizes: Iterable[int] = (224,),
+                          format: str = "jpeg", quality: int = 90, layout: str = "flat", workers: int = None,
+                          metadata_file: str = None) -> None:
+        """
+        Resizes and re-encodes downloaded images using a process pool, skipping images already up-to-date.
+
+        :param input: The directory of downloaded archives or extracted images.
+        :param output: The directory to save the images to, with one subdirectory per size.
+        :param sizes: The maximum width and height of the output images.
+        :param format: The output image format, one of "jpeg", "png" or "webp".
+        :param quality: The output quality for lossy formats.
+        :param layout: "flat" places all images of a size in one directory, "sharded" places them as resolved by sharded_path.
+        :param workers: How many worker processes should be used, defaults to the number of CPUs.
+        :param metadata_file: The previously downloaded metadata file, used to schedule the largest images first.
+        """
+        params = PreprocessCommandParameters(input=input, metadata_file=metadata_file, output=output, size=tuple(sizes), format=format,
+                                             quality=quality, layout=layout, workers=workers or os.cpu_count())
+
+        preprocess_images(params)
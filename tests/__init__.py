@@ -0,0 +1,4 @@
+"""
+Author:     David Walshe
+Date:       12 February 2021
+"""
@@ -0,0 +1,253 @@
+"""
+Author:     David Walshe
+Date:       21 February 2021
+"""
+
+import io
+import json
+import os
+import types
+import zipfile
+from queue import Queue
+
+import pytest
+import requests
+
+from src.cli.commands.image import download
+from src.cli.commands.image.download import (make_batches, download_images, DownloadCommandParameters, MAX_DOWNLOAD_SIZE,
+                                             batch_file_name, make_request, download_part, part_state_file, write_part_state,
+                                             verify_archive, remove_stale_parts)
+
+
+class FakeResponse(object):
+    """A streamed response, optionally breaking after a number of bytes."""
+
+    def __init__(self, status_code: int, body: bytes = b"", headers: dict = None, break_after: int = None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.break_after = break_after
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __bool__(self):
+        return self.status_code < 400
+
+    def iter_content(self, chunk_size: int):
+        end = len(self.body) if self.break_after is None else self.break_after
+        for start in range(0, end, chunk_size):
+            yield self.body[start:min(start + chunk_size, end)]
+        if end < len(self.body):
+            raise requests.exceptions.ConnectionError("Connection broken.")
+
+
+class FakeApi(object):
+    """Returns scripted responses, recording the headers of each request."""
+
+    def __init__(self, *responses: FakeResponse):
+        self.responses = list(responses)
+        self.requests = []
+
+    def resize_pool(self, pool_size: int):
+        pass
+
+    def get(self, endpoint: str, timeout: int = 5, headers: dict = None, stream: bool = False):
+        self.requests.append(headers)
+        return self.responses.pop(0)
+
+
+RESUMABLE = {"Accept-Ranges": "bytes", "ETag": '"v1"'}
+
+
+def make_archive() -> bytes:
+    """A valid zip archive larger than two streamed chunks."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as zip_ref:
+        zip_ref.writestr("ISIC-images/ISIC_0000000.jpg", os.urandom(300000))
+
+    return buffer.getvalue()
+
+
+def make_part(tmp_path, data: bytes, state: dict = None) -> str:
+    """A partial download with its resume state."""
+    part_file = str(tmp_path / "download.zip.part")
+    with open(part_file, "wb") as fh:
+        fh.write(data)
+    with open(part_state_file(part_file), "w") as fh:
+        json.dump(state if state is not None else {"accept_ranges": True, "validator": '"v1"'}, fh)
+
+    return part_file
+
+
+def read(path: str) -> bytes:
+    with open(path, "rb") as fh:
+        return fh.read()
+
+
+def test_make_batches_keeps_every_id_once():
+    image_ids = [f"id{i}" for i in range(1000)]
+    batches = list(make_batches(image_ids, [i % 37 + 1 for i in range(1000)], MAX_DOWNLOAD_SIZE))
+
+    assert sorted(image_id for _, batch in batches for image_id in batch) == sorted(image_ids)
+    assert len(batches) == 4
+    assert all(len(batch) <= MAX_DOWNLOAD_SIZE for _, batch in batches)
+
+
+def test_make_batches_balances_sizes_and_yields_heaviest_first():
+    image_ids = [f"id{i}" for i in range(10)]
+    image_sizes = [100, 1, 1, 1, 1, 1, 1, 1, 1, 50]
+    batches = list(make_batches(image_ids, image_sizes, 5))
+
+    assert [size for size, _ in batches] == [104, 54]
+    assert "id0" in batches[0][1] and "id9" in batches[1][1]
+    assert [size for size, _ in batches] == [sum(image_sizes[int(i[2:])] for i in batch) for _, batch in batches]
+
+
+def test_make_batches_is_lazy_and_handles_no_ids():
+    assert isinstance(make_batches(["a"], [1], 1), types.GeneratorType)
+    assert list(make_batches([], [], MAX_DOWNLOAD_SIZE)) == []
+
+
+def test_download_images_sends_retry_batches_heaviest_first(tmp_path, monkeypatch):
+    requested = []
+    monkeypatch.setattr(download, "make_request", lambda api, image_set, params: requested.append(image_set))
+    api = types.SimpleNamespace(resize_pool=lambda pool_size: None)
+    params = DownloadCommandParameters(metadata_file=None, dataset=None, include="images", output=str(tmp_path),
+                                       retry=False, timeout=5, workers=1, where=None, attempts=1)
+    batches = [["a"], ["b", "c"], ["d"]]
+
+    download_images(params, Queue(), api=api, image_sizes=[1, 2, 3, 10], image_batches=batches)
+
+    assert requested == [["d"], ["b", "c"], ["a"]]
+
+
+def test_batch_file_name_is_stable_per_batch():
+    params = types.SimpleNamespace(output="out")
+
+    assert batch_file_name(params, ["a", "b"]) == batch_file_name(params, ["a", "b"])
+    assert batch_file_name(params, ["a", "b"]) != batch_file_name(params, ["a", "c"])
+
+
+def test_make_request_resumes_a_broken_transfer(tmp_path):
+    archive = make_archive()
+    api = FakeApi(FakeResponse(200, archive, RESUMABLE, break_after=131072),
+                  FakeResponse(206, archive[131072:], {"Content-Range": f"bytes 131072-{len(archive) - 1}/{len(archive)}"}))
+    params = types.SimpleNamespace(include="images", output=str(tmp_path), attempts=2, timeout=5)
+
+    download_file = make_request(api, ["ISIC_0000000"], params)
+
+    assert api.requests == [None, {"Range": "bytes=131072-", "If-Range": '"v1"'}]
+    assert read(download_file) == archive
+    assert zipfile.ZipFile(download_file).testzip() is None
+    assert os.listdir(tmp_path) == [os.path.basename(download_file)]
+
+
+def test_download_part_discards_a_mismatched_content_range(tmp_path):
+    part_file = make_part(tmp_path, b"x" * 100)
+    api = FakeApi(FakeResponse(206, b"y" * 50, {"Content-Range": "bytes 0-49/150"}))
+
+    with pytest.raises(ValueError):
+        download_part(api, "image/download", part_file, 5)
+
+    assert not os.path.exists(part_file) and not os.path.exists(part_state_file(part_file))
+
+
+def test_download_part_appends_a_matching_content_range(tmp_path):
+    part_file = make_part(tmp_path, b"x" * 100)
+    api = FakeApi(FakeResponse(206, b"y" * 50, {"Content-Range": "bytes 100-149/150"}))
+
+    download_part(api, "image/download", part_file, 5)
+
+    assert read(part_file) == b"x" * 100 + b"y" * 50
+
+
+def test_download_part_restarts_when_if_range_fails(tmp_path):
+    part_file = make_part(tmp_path, b"x" * 100)
+    api = FakeApi(FakeResponse(200, b"z" * 150, {"Accept-Ranges": "bytes", "ETag": '"v2"'}))
+
+    download_part(api, "image/download", part_file, 5)
+
+    assert api.requests == [{"Range": "bytes=100-", "If-Range": '"v1"'}]
+    assert read(part_file) == b"z" * 150
+    assert json.loads(read(part_state_file(part_file))) == {"accept_ranges": True, "validator": '"v2"'}
+
+
+def test_download_part_416_when_already_complete(tmp_path):
+    part_file = make_part(tmp_path, b"x" * 100)
+    api = FakeApi(FakeResponse(416, headers={"Content-Range": "bytes */100"}))
+
+    download_part(api, "image/download", part_file, 5)
+
+    assert len(api.requests) == 1
+    assert read(part_file) == b"x" * 100
+
+
+def test_download_part_416_refetches_a_mismatched_part(tmp_path):
+    part_file = make_part(tmp_path, b"x" * 100)
+    api = FakeApi(FakeResponse(416, headers={"Content-Range": "bytes */90"}), FakeResponse(200, b"z" * 90, RESUMABLE))
+
+    download_part(api, "image/download", part_file, 5)
+
+    assert api.requests == [{"Range": "bytes=100-", "If-Range": '"v1"'}, None]
+    assert read(part_file) == b"z" * 90
+
+
+@pytest.mark.parametrize("state", [{"accept_ranges": False, "validator": '"v1"'}, {"accept_ranges": True, "validator": None}])
+def test_download_part_without_ranges_or_validator_downloads_again(tmp_path, state):
+    part_file = make_part(tmp_path, b"x" * 100, state)
+    api = FakeApi(FakeResponse(200, b"z" * 150))
+
+    download_part(api, "image/download", part_file, 5)
+
+    assert api.requests == [None]
+    assert read(part_file) == b"z" * 150
+
+
+def test_write_part_state_ignores_weak_etags(tmp_path):
+    part_file = str(tmp_path / "download.zip.part")
+
+    write_part_state(part_file, {"Accept-Ranges": "bytes", "ETag": 'W/"v1"', "Last-Modified": "Tue, 23 Feb 2021 10:00:00 GMT"})
+    assert json.loads(read(part_state_file(part_file)))["validator"] == "Tue, 23 Feb 2021 10:00:00 GMT"
+
+    write_part_state(part_file, {"ETag": 'W/"v1"'})
+    assert json.loads(read(part_state_file(part_file))) == {"accept_ranges": False, "validator": None}
+
+
+def test_download_part_raises_on_error_responses(tmp_path):
+    with pytest.raises(ValueError):
+        download_part(FakeApi(FakeResponse(500)), "image/download", str(tmp_path / "download.zip.part"), 5)
+
+
+def test_verify_archive_discards_a_corrupt_archive(tmp_path):
+    part_file = make_part(tmp_path, b"not a zip archive")
+
+    with pytest.raises(ValueError):
+        verify_archive(part_file)
+
+    assert not os.path.exists(part_file) and not os.path.exists(part_state_file(part_file))
+
+
+def test_make_request_downloads_a_corrupt_archive_again(tmp_path):
+    archive = make_archive()
+    api = FakeApi(FakeResponse(200, archive[:-10], RESUMABLE), FakeResponse(200, archive, RESUMABLE))
+    params = types.SimpleNamespace(include="images", output=str(tmp_path), attempts=2, timeout=5)
+
+    download_file = make_request(api, ["ISIC_0000000"], params)
+
+    assert api.requests == [None, None]
+    assert read(download_file) == archive
+
+
+def test_remove_stale_parts_keeps_only_failed_batches(tmp_path):
+    params = types.SimpleNamespace(output=str(tmp_path))
+    kept, stale = (f"{batch_file_name(params, batch)}.part" for batch in (["a"], ["b"]))
+    for path in (kept, part_state_file(kept), stale, part_state_file(stale), str(tmp_path / "orphan.zip.part.json"), str(tmp_path / "done.zip")):
+        open(path, "wb").close()
+
+    remove_stale_parts(params, [["a"]])
+
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(path) for path in (kept, part_state_file(kept), str(tmp_path / "done.zip")))
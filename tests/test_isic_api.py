@@ -0,0 +1,58 @@
+"""
+Author:     David Walshe
+Date:       12 February 2021
+"""
+
+import threading
+
+import pytest
+
+from src.api.isic_api import IsicApi
+
+
+class FakeApi(IsicApi):
+    """Serves pages of a fixed result set without any network access."""
+
+    def __init__(self, total: int):
+        super().__init__()
+        self.total = total
+        self.offsets = []
+        self.lock = threading.Lock()
+
+    def get_json(self, endpoint, limit: int = 50, offset: int = 0, timeout: int = 5):
+        with self.lock:
+            self.offsets.append(offset)
+        return list(range(offset, min(offset + limit, self.total)))
+
+
+@pytest.mark.parametrize("prefetch", [0, 1, 3])
+def test_get_json_list_returns_items_in_order(prefetch):
+    api = FakeApi(total=23)
+
+    assert list(api.get_json_list("image?", limit=5, prefetch=prefetch)) == list(range(23))
+
+
+@pytest.mark.parametrize("prefetch", [1, 3])
+def test_get_json_list_prefetch_is_bounded(prefetch):
+    api = FakeApi(total=23)
+    list(api.get_json_list("image?", limit=5, prefetch=prefetch))
+
+    # The first empty page ends the listing, with at most `prefetch` requests issued past it.
+    assert sorted(api.offsets)[:6] == [0, 5, 10, 15, 20, 25]
+    assert len(api.offsets) <= 6 + prefetch - 1
+
+
+def test_get_json_list_prefetch_stops_when_closed():
+    api = FakeApi(total=10000)
+    items = api.get_json_list("image?", limit=5, prefetch=3)
+
+    assert next(items) == 0
+    items.close()
+
+    assert len(api.offsets) <= 4
+
+
+def test_get_json_list_starts_at_offset():
+    api = FakeApi(total=12)
+
+    assert list(api.get_json_list("image?", limit=5, offset=5, prefetch=2)) == list(range(5, 12))
@@ -0,0 +1,127 @@
+"""
+Author:     David Walshe
+Date:       23 February 2021
+"""
+
+import io
+import os
+import stat
+import time
+from zipfile import ZipFile
+
+from PIL import Image
+
+from src.cli.utils import get_umask
+from src.cli.commands.image.preprocess import (PreprocessCommandParameters, preprocess_images, preprocess_image, find_images,
+                                               schedule_images, is_up_to_date, target_path)
+
+
+def make_jpeg(size: tuple) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color=(200, 100, 50)).save(buffer, format="JPEG")
+
+    return buffer.getvalue()
+
+
+def make_zip(path: str, images: dict, mtime: float = None) -> str:
+    """A downloaded archive of generated JPEGs, keyed by image name."""
+    with ZipFile(path, "w") as zip_ref:
+        for name, size in images.items():
+            zip_ref.writestr(f"ISIC-images/HAM10000/{name}.jpg", make_jpeg(size))
+        zip_ref.writestr("ISIC-images/HAM10000/LICENSE.txt", b"license")
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+    return path
+
+
+def make_params(input: str, output: str, **kwargs) -> PreprocessCommandParameters:
+    defaults = dict(metadata_file=None, size=(64, 32), format="jpeg", quality=90, layout="flat", workers=1)
+    defaults.update(kwargs)
+
+    return PreprocessCommandParameters(input=input, output=output, **defaults)
+
+
+def test_find_images_keeps_the_newest_copy_of_each_image(tmp_path):
+    make_zip(str(tmp_path / "a.zip"), {"ISIC_0000000": (40, 30), "ISIC_0000001": (40, 30)}, mtime=1000)
+    newer = make_zip(str(tmp_path / "b.zip"), {"ISIC_0000001": (40, 30)}, mtime=2000)
+
+    tasks = find_images(make_params(str(tmp_path), str(tmp_path / "out")))
+
+    assert sorted(os.path.basename(task[1]) for task in tasks) == ["ISIC_0000000.jpg", "ISIC_0000001.jpg"]
+    assert [task[0] for task in tasks if task[1].endswith("ISIC_0000001.jpg")] == [newer]
+
+
+def test_find_images_skips_the_output_directory(tmp_path):
+    Image.new("RGB", (10, 10)).save(tmp_path / "ISIC_0000000.jpg")
+    (tmp_path / "out").mkdir()
+    Image.new("RGB", (10, 10)).save(tmp_path / "out" / "ISIC_0000001.jpg")
+
+    tasks = find_images(make_params(str(tmp_path), str(tmp_path / "out")))
+
+    assert [task[0] for task in tasks] == [str(tmp_path / "ISIC_0000000.jpg")]
+
+
+def test_schedule_images_orders_largest_first(tmp_path):
+    tasks = [("a.zip", "ISIC_0000000.jpg", 0, 10), ("a.zip", "ISIC_0000001.jpg", 0, 30), ("a.zip", "ISIC_0000002.jpg", 0, 20)]
+
+    scheduled = schedule_images(make_params("a.zip", "out"), tasks)
+    assert [task[1] for task in scheduled] == ["ISIC_0000001.jpg", "ISIC_0000002.jpg", "ISIC_0000000.jpg"]
+
+    metadata_file = tmp_path / "metadata.csv"
+    metadata_file.write_text("image_name,pixels_x,pixels_y\nISIC_0000000,1000,1000\nISIC_0000001,5,5\n")
+
+    scheduled = schedule_images(make_params("a.zip", "out", metadata_file=str(metadata_file)), tasks)
+    assert [task[1] for task in scheduled] == ["ISIC_0000000.jpg", "ISIC_0000002.jpg", "ISIC_0000001.jpg"]
+
+
+def test_is_up_to_date(tmp_path):
+    target = tmp_path / "ISIC_0000000.jpg"
+
+    assert not is_up_to_date(str(target), 1000)
+
+    target.write_bytes(b"image")
+    os.utime(target, (2000, 2000))
+
+    assert is_up_to_date(str(target), 1000)
+    assert is_up_to_date(str(target), 2000)
+    assert not is_up_to_date(str(target), 3000)
+
+
+def test_preprocess_image_writes_each_missing_size(tmp_path):
+    archive = make_zip(str(tmp_path / "a.zip"), {"ISIC_0000000": (200, 100)})
+    params = make_params(archive, str(tmp_path / "out"), layout="sharded")
+    task = find_images(params)[0]
+
+    written, cpu_time = preprocess_image(task, params)
+
+    assert written == 2 and cpu_time >= 0
+    for size in params.size:
+        target = target_path(params, size, task)
+        assert Image.open(target).size == (size, size // 2)
+        assert stat.S_IMODE(os.stat(target).st_mode) == 0o666 & ~get_umask()
+    assert preprocess_image(task, params)[0] == 0
+
+
+def test_preprocess_images_resizes_and_skips_up_to_date_images(tmp_path):
+    images = {"ISIC_0000000": (200, 100), "ISIC_0000001": (50, 120), "ISIC_0000002": (20, 20)}
+    archive = make_zip(str(tmp_path / "a.zip"), images, mtime=1000)
+    params = make_params(str(tmp_path), str(tmp_path / "out"), workers=2)
+
+    preprocess_images(params)
+
+    outputs = sorted(str(path) for path in (tmp_path / "out").rglob("*") if path.is_file())
+    assert outputs == sorted(str(tmp_path / "out" / str(size) / f"{name}.jpg") for size in params.size for name in images)
+    for size in params.size:
+        for name, source_size in images.items():
+            output_size = Image.open(tmp_path / "out" / str(size) / f"{name}.jpg").size
+            assert max(output_size) == min(size, max(source_size))
+
+    mtimes = {path: os.path.getmtime(path) for path in outputs}
+    preprocess_images(params)
+    assert {path: os.path.getmtime(path) for path in outputs} == mtimes
+
+    # A newer archive makes its images stale.
+    os.utime(archive, (time.time() + 100, time.time() + 100))
+    preprocess_images(params)
+    assert all(os.path.getmtime(path) > mtimes[path] for path in outputs)
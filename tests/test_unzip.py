@@ -0,0 +1,55 @@
+"""
+Author:     David Walshe
+Date:       23 February 2021
+"""
+
+import os
+import stat
+from zipfile import ZipFile
+
+from src.cli.utils import get_umask
+from src.cli.commands.image.unzip import sharded_path, unzip_images, UnzipCommandParameters
+
+
+def test_sharded_path_is_deterministic():
+    assert sharded_path("root", "ISIC_0000000.jpg") == sharded_path("root", "ISIC_0000000.jpg")
+
+
+def test_sharded_path_layout():
+    root, shard, filename = sharded_path("root", "ISIC_0000000.jpg").split(os.sep)
+
+    assert root == "root"
+    assert filename == "ISIC_0000000.jpg"
+    assert len(shard) == 2 and int(shard, 16) < 256
+
+
+def test_sharded_path_keeps_image_and_metadata_together():
+    image = sharded_path("root", "ISIC_0000000.jpg")
+    metadata = sharded_path("root", "ISIC_0000000.json")
+
+    assert os.path.dirname(image) == os.path.dirname(metadata)
+
+
+def test_sharded_path_spreads_files():
+    shards = {os.path.dirname(sharded_path("root", f"ISIC_{i:07d}.jpg")) for i in range(2000)}
+
+    assert len(shards) > 200
+
+
+def test_unzip_images_file_modes_match_layouts(tmp_path):
+    zip_dir = tmp_path / "zips"
+    zip_dir.mkdir()
+    with ZipFile(zip_dir / "download.zip", "w") as zip_ref:
+        zip_ref.writestr("ISIC-images/HAM10000/ISIC_0000000.jpg", b"image")
+        zip_ref.writestr("ISIC-images/LICENSE.txt", b"license")
+
+    for layout in ("flat", "sharded"):
+        unzip_images(UnzipCommandParameters(zip_dir=str(zip_dir), output=str(tmp_path / layout), workers=1, layout=layout))
+
+    paths = [tmp_path / "flat" / "ISIC-images" / "HAM10000" / "ISIC_0000000.jpg",
+             tmp_path / "flat" / "ISIC-images" / "LICENSE.txt",
+             sharded_path(str(tmp_path / "sharded"), "ISIC_0000000.jpg"),
+             tmp_path / "sharded" / "ISIC-images" / "LICENSE.txt"]
+
+    assert [stat.S_IMODE(os.stat(path).st_mode) for path in paths] == [0o666 & ~get_umask()] * len(paths)
+    assert not list((tmp_path / "sharded").rglob("*.tmp"))
@@ -0,0 +1,131 @@
+"""
+Author:     David Walshe
+Date:       12 February 2021
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pytest
+
+from src.cli.utils import submit_bounded, where_columns, filter_dataframe, WhereExpressionError
+
+
+class CountingItems(object):
+    """An iterable recording how many items have been pulled from it."""
+
+    def __init__(self, n: int):
+        self.n = n
+        self.pulled = 0
+
+    def __iter__(self):
+        for item in range(self.n):
+            self.pulled += 1
+            yield item
+
+
+def test_submit_bounded_returns_every_item_with_its_result():
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        results = {item: future.result() for item, future in submit_bounded(executor, lambda x: x * 2, range(50), 6)}
+
+    assert results == {item: item * 2 for item in range(50)}
+
+
+def test_submit_bounded_submits_in_iterable_order():
+    submitted = []
+
+    def record(item):
+        submitted.append(item)
+        return item
+
+    # A single worker runs tasks in submission order.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        list(submit_bounded(executor, record, range(20), 4))
+
+    assert submitted == list(range(20))
+
+
+def test_submit_bounded_yields_in_completion_order():
+    delays = {0: 0.2, 1: 0.0}
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        handed_back = [item for item, _ in submit_bounded(executor, lambda x: time.sleep(delays[x]), [0, 1], 2)]
+
+    assert handed_back == [1, 0]
+
+
+def test_submit_bounded_limits_tasks_in_flight():
+    items = CountingItems(100)
+    running = 0
+    max_running = 0
+    lock = threading.Lock()
+
+    def work(item):
+        nonlocal running, max_running
+        with lock:
+            running += 1
+            max_running = max(max_running, running)
+        time.sleep(0.001)
+        with lock:
+            running -= 1
+
+    handed_back = 0
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for _ in submit_bounded(executor, work, items, 4):
+            # Submitted tasks include the one just handed back.
+            assert items.pulled - handed_back <= 4
+            handed_back += 1
+
+    assert handed_back == 100
+    assert max_running <= 4
+
+
+def test_submit_bounded_stops_pulling_items_when_closed_early():
+    items = CountingItems(1000)
+    started = []
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        completed = submit_bounded(executor, lambda x: started.append(x) or time.sleep(0.01), items, 5)
+        next(completed)
+        completed.close()
+
+    assert items.pulled <= 6
+    # Tasks that had not started were cancelled.
+    assert len(started) < items.pulled
+
+
+@pytest.mark.parametrize("max_in_flight", [0, 1, 3, 100])
+def test_submit_bounded_capacity(max_in_flight):
+    items = CountingItems(10)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        completed = submit_bounded(executor, lambda x: x, items, max_in_flight)
+        # Nothing is submitted until the generator starts.
+        assert items.pulled == 0
+        next(completed)
+        # The window is filled up front, with at least one task.
+        assert items.pulled == min(max(max_in_flight, 1), 10)
+        assert len(list(completed)) == 9
+
+
+def test_where_columns_finds_referenced_columns():
+    columns = ["isic_id", "benign_malignant", "pixels_x", "pixels_y", "age"]
+
+    assert where_columns("benign_malignant == 'malignant' and pixels_x >= 1024", columns) == ["benign_malignant", "pixels_x"]
+    assert where_columns("`age` > 50", columns) == ["age"]
+    assert where_columns("unknown > 1", columns) == []
+
+
+def test_filter_dataframe():
+    df = pd.DataFrame({"pixels_x": [512, 2048], "benign_malignant": ["benign", "malignant"]})
+
+    assert list(filter_dataframe(df, "pixels_x >= 1024").index) == [1]
+    assert filter_dataframe(df, None) is df
+
+    with pytest.raises(WhereExpressionError):
+        filter_dataframe(df, "pixels_x")
+
+    with pytest.raises(ValueError):
+        filter_dataframe(df, "pixels_x >")